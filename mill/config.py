@@ -46,13 +46,24 @@ def rewrite_config(source='config.py'):
 	with open(source,'w') as fp: 
 		fp.write('#!/usr/bin/env python -B\n'+str(pprint.pformat(config,width=110)))
 
+#---results of PATH lookups for is_terminal_command
+_terminal_commands = {}
+
 def is_terminal_command(name):
 	"""
-	"""
-	check_which = subprocess.Popen('which %s'%name,shell=True,executable='/bin/bash',
-		stdout=subprocess.PIPE,stderr=subprocess.PIPE)
-	check_which.communicate()
-	return check_which.returncode
+	Check for a command on the PATH. Returns a shell-style code (zero when the command exists) and 
+	remembers the answer for the rest of the process.
+	"""
+	if name not in _terminal_commands:
+		#---shutil.which walks the PATH without spawning a shell (python 3.3+)
+		try: from shutil import which
+		except ImportError:
+			check_which = subprocess.Popen('which %s'%name,shell=True,executable='/bin/bash',
+				stdout=subprocess.PIPE,stderr=subprocess.PIPE)
+			check_which.communicate()
+			_terminal_commands[name] = check_which.returncode
+		else: _terminal_commands[name] = 0 if which(name) else 1
+	return _terminal_commands[name]
 
 def bash(command,log=None,cwd=None,inpipe=None,catch=False):
 	"""
@@ -67,15 +78,17 @@ def bash(command,log=None,cwd=None,inpipe=None,catch=False):
 		stdout,stderr = proc.communicate()
 	else:
 		#---if the log is not in cwd we see if it is accessible from the calling directory
-		if not os.path.isdir(os.path.dirname(os.path.join(cwd,log))): 
-			output = open(os.path.join(os.getcwd(),log),'w')
-		else: output = open(os.path.join(cwd,log),'w')
-		kwargs = dict(cwd=cwd,shell=True,executable='/bin/bash',
-			stdout=output,stderr=output)
-		if inpipe: kwargs['stdin'] = subprocess.PIPE
-		proc = subprocess.Popen(command,**kwargs)
-		if not inpipe: stdout,stderr = proc.communicate()
-		else: stdout,stderr = proc.communicate(input=inpipe)
+		if not os.path.isdir(os.path.dirname(os.path.join(cwd,log))): log_fn = os.path.join(os.getcwd(),log)
+		else: log_fn = os.path.join(cwd,log)
+		#---the child writes straight to the log file so output is never held in memory here
+		with open(log_fn,'w') as output:
+			kwargs = dict(cwd=cwd,shell=True,executable='/bin/bash',
+				stdout=output,stderr=subprocess.STDOUT)
+			if inpipe: kwargs['stdin'] = subprocess.PIPE
+			proc = subprocess.Popen(command,**kwargs)
+			if not inpipe: stdout,stderr = None,None
+			else: stdout,stderr = proc.communicate(input=inpipe)
+			proc.wait()
 	if stderr: raise Exception('[ERROR] bash returned error state: %s'%stderr)
 	if proc.returncode: 
 		if log: raise Exception('bash error, see %s'%log)
@@ -130,10 +130,11 @@ def connect_single(connection_name,**specs):
 	#---note that "PROJECT_NAME" is therefore protected and always refers to the 
 	#---...top-level key in connect.yaml
 	#---! note that you cannot use PROJECT_NAME in spots currently
+	#---PROJECT_NAME is a literal so we use a plain string replace rather than the regex engine
 	for key,val in specs.items():
-		if type(val)==str: specs[key] = re.sub('PROJECT_NAME',connection_name,val)
+		if type(val)==str: specs[key] = val.replace('PROJECT_NAME',connection_name)
 		elif type(val)==list:
-			for ii,i in enumerate(val): val[ii] = re.sub('PROJECT_NAME',connection_name,i)
+			for ii,i in enumerate(val): val[ii] = i.replace('PROJECT_NAME',connection_name)
 	#---paths defaults
 	specs['plot_spot'] = specs.get('plot_spot',os.path.join('data',connection_name,'plot')) 
 	specs['post_spot'] = specs.get('post_spot',os.path.join('data',connection_name,'post')) 
@@ -143,7 +144,7 @@ def connect_single(connection_name,**specs):
 	for spotname,spot_details in specs.get('spots',{}).items():
 		for key,val in spot_details.items():
 			if type(val) in str_types:
-				specs['spots'][spotname][key] = re.sub('PROJECT_NAME',connection_name,val)
+				specs['spots'][spotname][key] = val.replace('PROJECT_NAME',connection_name)
 			#---we also expand paths for route_to_data
 			specs['spots'][spotname]['route_to_data'] = os.path.expanduser(os.path.abspath(
 				specs['spots'][spotname]['route_to_data']))
@@ -441,13 +442,12 @@ def template(template=None,connection_file=None,project_name=None):
 	Otherwise, only the template name is required.
 	"""
 	if not os.path.isdir('connections'): os.mkdir('connections')
-	template_source = 'connection_templates.py'
-	if sys.version_info<(3,0):
-		templates = {}
-		execfile(os.path.join(os.path.dirname(__file__),template_source),templates)
-		for key in [i for i in templates if not re.match('^template_',i)]: templates.pop(key)
-		asciitree({'templates':[re.match('^template_(.+)$',k).group(1) for k in templates.keys()]})
-	else: raise Exception('dev')
+	#---import the templates once as a module instead of executing the source on every call
+	#---...the templates stay as text so that the comments are written to the connection file
+	import connection_templates
+	templates = dict([(key,val) for key,val in vars(connection_templates).items() 
+		if key.startswith('template_')])
+	asciitree({'templates':[re.match('^template_(.+)$',k).group(1) for k in templates.keys()]})
 	#---if the user requests a template, write it for them
 	if not template and not connection_file: print('[NOTE] rerun with e.g. '+
 		'`make template <template_name>` to make a new connection with the same name as the template. '+
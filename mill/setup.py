@@ -6,10 +6,41 @@ Prepare or check that the environment is ready for the factory.
 
 __all__ = ['nuke','renew','setup','init','help']
 
-import os,sys,time,re,shutil,textwrap,glob
+import os,sys,time,glob,hashlib,copy,stat,errno
 from config import read_config,write_config,is_terminal_command,bash,abspath
 from makeface import fab
-from datapack import asciitree
+
+#---read-only dictionary views are not available in python 2
+try: from types import MappingProxyType
+except ImportError: MappingProxyType = None
+
+#---raw_input was renamed to input in python 3
+try: _prompt = raw_input
+except NameError: _prompt = input
+
+def req_hash(fn):
+	"""
+	Hash the contents of a requirements file.
+	"""
+	with open(fn,'rb') as fp:
+		#---python 3.11 can hash straight from the file handle
+		if hasattr(hashlib,'file_digest'): return hashlib.file_digest(fp,'sha256').hexdigest()
+		else: return hashlib.sha256(fp.read()).hexdigest()
+
+def req_mtime(st):
+	"""
+	Modification time from a stat result. Python 3 gives integer nanoseconds which compare exactly.
+	"""
+	return getattr(st,'st_mtime_ns',st.st_mtime)
+
+def mkdir_quiet(dn):
+	"""
+	Make a folder if it is absent. Trying first costs one syscall instead of a stat and a mkdir.
+	"""
+	#---python 2 has no exist_ok flag for makedirs
+	try: os.mkdir(dn)
+	except OSError as e:
+		if e.errno!=errno.EEXIST: raise
 
 class FactoryEnv:
 
@@ -56,8 +87,10 @@ class FactoryEnv:
 			'use_python2':True},}
 	#---! need a place to store env path !!! (see above; it's in the activate_script)	
 	#---sandbox mimics the virtualenv and uses the same setup, with an extra flag not encoded here
-	meta['virtualenv_sandbox'] = dict(meta['virtualenv'])
+	meta['virtualenv_sandbox'] = copy.deepcopy(meta['virtualenv'])
 	meta['virtualenv_sandbox']['setup_kickstart'] = 'setup_virtualenv_sandbox'
+	#---the defaults are read-only once they are built (instances receive deep copies)
+	if MappingProxyType: meta = MappingProxyType(meta)
 	#---folder we always need at root
 	required_folders = ['logs','connections']
 
@@ -66,13 +99,17 @@ class FactoryEnv:
 		Create a factory environment from instructions in the config, and setup or refresh if necessary.
 		"""
 		#---create required folders for the factory
-		for fn in self.required_folders:
-			if not os.path.isdir(fn): os.mkdir(fn)
+		for fn in self.required_folders: mkdir_quiet(fn)
 		#---get a copy of the configuration
 		self.config = read_config()
 		self.timestamp = self.config.get('setup_stamp',None)
+		#---legacy stamps came from strftime('%Y%m%d%H%M%s') where glibc appends the current epoch to the date
+		if self.timestamp and len(str(self.timestamp))>len('%d'%time.time()):
+			self.timestamp = int(str(self.timestamp)[len(time.strftime('%Y%m%d%H%M')):])
 		kind = self.config.get('species',None)
 		if kind not in self.meta:
+			import textwrap
+			from datapack import asciitree
 			msg = ('It looks like this is your first time.'
 				'To get started with the factory, you have to choose a virtual environment. '
 				'Even if you have lots of dank packages installed on your linux box, we still use (at least) '
@@ -89,7 +126,13 @@ class FactoryEnv:
 			asciitree({'envs':self.meta.keys()})
 			sys.exit(1)
 		self.kind = kind
-		for key in self.meta[kind]: self.__dict__[key] = self.meta[kind][key]
+		self.refresh = refresh
+		#---requirements hashed by register_installed during this run (not prefixed "reqs" on purpose)
+		self.installed_reqs = set()
+		#---copy the defaults so that changes to e.g. loader_commands do not leak back into the class
+		self.__dict__.update(copy.deepcopy(self.meta[kind]))
+		#---loader settings must be right whether or not we refresh because register_finished records them
+		self.set_loader()
 		#---make sure all requirements files are available no matter what 
 		do_refresh = (self.timestamp and self.check_spotchange()) or refresh
 		#---environment creation is divided into two parts: first run and refreshes
@@ -102,19 +145,65 @@ class FactoryEnv:
 		self.register_finished()
 		if hasattr(self,self.welcome): getattr(self,self.welcome)()
 
+	def set_loader(self):
+		"""
+		Point the activate and source commands at the python 2 environment if the species requires it.
+		"""
+		if getattr(self,'use_python2',False):
+			#! note that anaconda may have deprecated use of env/envs/py2/bin/activate
+			self.loader_commands['env_activate'] = 'env/bin/activate py2'
+			self.source_cmd = 'source env/bin/activate py2'
+
+	def reqs_files(self):
+		"""
+		Iterate over the requirements files named by any attribute that starts with "reqs".
+		"""
+		reqs_keys = [i for i in self.__dict__ if i.startswith('reqs')]
+		for req_type in reqs_keys:
+			for fn in self.__dict__[req_type]: yield fn
+
+	def _req_hashes(self):
+		"""
+		Hash the contents of the requirements files so that touching a file does not trigger a refresh.
+		Files already hashed by register_installed during this run are skipped.
+		"""
+		return dict([(fn,req_hash(fn)) for fn in self.reqs_files() if fn not in self.installed_reqs])
+
+	def changed_reqs(self,fns):
+		"""
+		Select requirements files whose contents changed since they were last installed.
+		"""
+		#---first runs and forced refreshes install everything
+		if not self.timestamp or self.refresh: return list(fns)
+		hashes = self.config.get('reqs_hashes',{})
+		return [fn for fn in fns if hashes.get(fn)!=req_hash(fn)]
+
+	def register_installed(self,fns):
+		"""
+		Record the hashes of requirements files after a successful install so later refreshes can skip them.
+		"""
+		self.config.setdefault('reqs_hashes',{}).update(dict([(fn,req_hash(fn)) for fn in fns]))
+		self.installed_reqs.update(fns)
+		write_config(self.config)
+
 	def check_spotchange(self):
 		"""
 		Given a timestamp we see if any of the spots have changed. If they have, we run the refresh routine.
 		"""
-		reqs_keys = [i for i in self.__dict__ if re.match('^reqs',i)]
-		#---loop over keys that start with "reqs" to check requirements files
-		for req_type in reqs_keys:
-			#---check spotchange only if timestamp is not None
-			fns_changed = [fn for fn in self.__dict__[req_type] if 
-				int(time.strftime('%Y%m%d%H%M%s',time.localtime(os.path.getmtime(fn))))>int(self.timestamp)]
-		#---any requirement change requires a refresh
-		#---! note that it might be useful to only run pip install on the ones that change?
-		return any(fns_changed)
+		#---modification times recorded at the last setup let us skip files that have not been touched
+		mtimes = self.config.get('reqs_mtime_cache',{})
+		hashes = self.config.get('reqs_hashes',{})
+		ts = int(self.timestamp)
+		def changed(fn):
+			"""Only hash a file if its modification time moved since the last setup."""
+			#---stat once and reuse the result for both comparisons
+			st = os.stat(fn)
+			if mtimes.get(fn)==req_mtime(st): return False
+			elif fn in hashes: return req_hash(fn)!=hashes[fn]
+			else: return int(st.st_mtime)>ts
+		#---any requirement change requires a refresh so we stop at the first changed file
+		#---...and the refresh itself only reinstalls the files that changed (see changed_reqs)
+		return any(changed(fn) for fn in self.reqs_files())
 
 	def register_finished(self):
 		"""
@@ -123,7 +212,10 @@ class FactoryEnv:
 		#---record success and load/unload commands for the environment
 		if hasattr(self,'loader_commands'): 
 			self.config['activate_env'] = self.loader_commands['env_activate']
-		self.config['setup_stamp'] = time.strftime('%Y%m%d%H%M%s')
+		self.config['setup_stamp'] = int(time.time())
+		#---cache modification times and contents of the requirements for check_spotchange
+		self.config['reqs_mtime_cache'] = dict([(fn,req_mtime(os.stat(fn))) for fn in self.reqs_files()])
+		self.config.setdefault('reqs_hashes',{}).update(self._req_hashes())
 		write_config(self.config)
 
 	def setup_virtualenv_sandbox(self): 
@@ -161,10 +253,13 @@ class FactoryEnv:
 		"""
 		Refresh the virtualenvironment.
 		"""
-		for fn in self.reqs:
-			print('[STATUS] installing packages via pip from %s'%fn)
-			bash(self.source_cmd+' && pip install -r %s'%fn,
-				log='logs/log-virtualenv-pip-%s'%os.path.basename(fn))
+		#---a single pip call resolves dependencies for all requirements files at once
+		reqs = self.changed_reqs(self.reqs)
+		if reqs:
+			print('[STATUS] installing packages via pip from %s'%', '.join(reqs))
+			bash(self.source_cmd+' && pip install %s'%' '.join(['-r %s'%fn for fn in reqs]),
+				log='logs/log-virtualenv-pip-reqs')
+			self.register_installed(reqs)
 		#---custom handling for required upgrades
 		#---! would be useful to make this systematic
 		required_upgrades = ['Sphinx>=1.4.4','numpydoc','sphinx-better-theme','beautifulsoup4']
@@ -176,9 +271,10 @@ class FactoryEnv:
 		"""
 		This is identical to the test function in shipping.py.
 		"""
-		from makeface import fab
-		from distutils.spawn import find_executable
-		print(fab('ENVIRONMENT:','cyan_black')+' %s'%find_executable('python'))
+		#---distutils is gone in python 3.12 so we only fall back to it on python 2
+		try: from shutil import which
+		except ImportError: from distutils.spawn import find_executable as which
+		print(fab('ENVIRONMENT:','cyan_black')+' %s'%which('python'))
 
 	def setup_anaconda(self):
 		"""
@@ -187,8 +283,12 @@ class FactoryEnv:
 		anaconda_location = self.config.get('anaconda_location',None)
 		if not anaconda_location: 
 			raise Exception('download anaconda and run `make set anaconda_location <path>`')
-		install_fn = abspath(anaconda_location)
-		if not os.path.isfile(install_fn) and not (os.path.islink(install_fn) and not os.path.isdir(install_fn)):
+		#---only resolve relative or home-directory paths
+		install_fn = anaconda_location if os.path.isabs(anaconda_location) else abspath(anaconda_location)
+		#---a single stat confirms the installer exists (following links) and is not a directory
+		try: install_ok = not stat.S_ISDIR(os.stat(install_fn).st_mode)
+		except OSError: install_ok = False
+		if not install_ok:
 			raise Exception('cannot find %s. make sure you have a copy of anaconda there.'%install_fn+
 				'or run `make set anaconda_location=~/path/to/Miniconda3-latest-<architecture>.sh` '
 				'to use a different path.')
@@ -204,8 +304,7 @@ class FactoryEnv:
 			#---we use the conda environment handler to avoid using the user site-packages in ~/.local
 			env_etc = 'env/envs/py2/etc'
 			env_etc_conda = 'env/envs/py2/etc/conda'
-			for dn in [env_etc,env_etc_conda]:
-				if not os.path.isdir(dn): os.mkdir(dn)
+			for dn in [env_etc,env_etc_conda]: mkdir_quiet(dn)
 			for dn in ['activate.d','deactivate.d']: os.mkdir(os.path.join(env_etc_conda,dn))
 			with open(os.path.join(env_etc_conda,'activate.d','env_vars.sh'),'w') as fp:
 				fp.write('#!/bin/sh\nexport PYTHONNOUSERSITE=True\n')
@@ -216,10 +315,7 @@ class FactoryEnv:
 		"""
 		Refresh the virtualenvironment.
 		"""
-		if self.use_python2:
-			#! note that anaconda may have deprecated use of env/envs/py2/bin/activate
-			self.loader_commands['env_activate'] = 'env/bin/activate py2'
-			self.source_cmd = 'source env/bin/activate py2'
+		#---set_loader already pointed source_cmd at the py2 environment if needed
 		#---we consult a conda YAML file and a PIP text list to install packages
 		#---default values are built into the class above but they can be overridden
 		config = read_config()
@@ -228,37 +324,51 @@ class FactoryEnv:
 		if type(reqs_conda)!=list: reqs_conda = [reqs_conda]
 		if type(reqs_pip)!=list: reqs_pip = [reqs_pip]
 		#---install from the conda requirements list followed by pip (for packages not available on conda)
-		for fn in reqs_conda:
+		#---only files that changed since their last install are processed unless this is a full refresh
+		for fn in self.changed_reqs(reqs_conda):
 			print('[STATUS] installing packages via conda from %s'%fn)
 			#---we tell conda to ignore local user site-packages because version errors
 			bash(self.source_cmd+' && conda env update --file %s'%fn,
 				log='logs/log-anaconda-conda-%s'%os.path.basename(fn))
-		for fn in reqs_pip:
-			print('[STATUS] installing packages via pip from %s'%fn)
-			bash(self.source_cmd+' && pip install -r %s'%fn,
-				log='logs/log-anaconda-conda-%s'%os.path.basename(fn))
+			self.register_installed([fn])
+		#---conda env update takes one file at a time but pip can resolve all of its lists together
+		reqs_pip = self.changed_reqs(reqs_pip)
+		if reqs_pip:
+			print('[STATUS] installing packages via pip from %s'%', '.join(reqs_pip))
+			bash(self.source_cmd+' && pip install %s'%' '.join(['-r %s'%fn for fn in reqs_pip]),
+				log='logs/log-anaconda-pip-reqs')
+			self.register_installed(reqs_pip)
+
+#---environments built in this process (see setup)
+_env_cache = {}
 
 def setup(refresh=False):
 	"""
 	Both setup and nuke have kwargs so they can be used with rewn (worth it).
+	The environment is only built once per process for each value of refresh.
 	"""
-	env = FactoryEnv(refresh=True)
+	key = (refresh,)
+	if key not in _env_cache: _env_cache[key] = FactoryEnv(refresh=refresh)
+	return _env_cache[key]
 		
 def nuke(sure=False,env=True):
 	"""
 	Start from scratch. Erases the environment and  resets the config. You must set the species after this.
 	"""
-	if sure or all(re.match('^(y|Y)',(input if sys.version_info>(3,0) else raw_input)
-		('[QUESTION] %s (y/N)? '%msg))!=None for msg in ['okay to nuke everything','confirm']):
+	if sure or all(_prompt('[QUESTION] %s (y/N)? '%msg).startswith(('y','Y')) 
+		for msg in ['okay to nuke everything','confirm']):
+		import shutil
 		#---reset procedure starts here
 		write_config({
 			'commands': ['mill/setup.py','mill/shipping.py','mill/factory.py'],
 			'commands_aliases': [('set','set_config')]})
 		#---we do not touch the connections, obviously, since you might nuke and reconnect
 		#---deleting sensitive stuff here
-		for fn in [i for i in ['data'] if os.path.isdir(i)]: shutil.rmtree(fn)
+		#---we only tolerate missing folders so we do not need to check for them first
 		for dn in (['env'] if env else [])+['logs','calc','data','pack','site']:
-			if os.path.isdir(dn): shutil.rmtree(dn)
+			try: shutil.rmtree(dn)
+			except OSError as e:
+				if e.errno!=errno.ENOENT: raise
 		#---nuking the interface development codes requires you to remove migrations. if you do not do this
 		#---...then any development modifications to the model requires more attention from the user,
 		#---...specifically to fill in columns on preexisting rows. this is obviously a great feature
@@ -279,18 +389,19 @@ def renew():
 			'~/libs first, or alter the path below)',[
 			'make nuke sure',
 			'make set species anaconda',
-			'make set anaconda_location=~/libs/Miniconda3-latest-Linux-x86_64.sh',
-			'make set automacs="http://github.com/biophyscode/automacs"',
-			'make set omnicalc="http://github.com/biophyscode/omnicalc"',
+			#---each make call starts python several times so we set the paths together
+			'make set anaconda_location=~/libs/Miniconda3-latest-Linux-x86_64.sh '+
+				'automacs="http://github.com/biophyscode/automacs" '+
+				'omnicalc="http://github.com/biophyscode/omnicalc"',
 			'make setup']),
 		('start from scratch but do not reinstall anaconda',[
 			'make nuke sure env=False',
 			'make set species anaconda',
-			'make set anaconda_location=~/libs/Miniconda3-latest-Linux-x86_64.sh',
-			'make set automacs="http://github.com/biophyscode/automacs"',
-			'make set omnicalc="http://github.com/biophyscode/omnicalc"',
-			'make set setup_stamp=$(date +%Y%m%d%H%M%s)',
-			'make setup',]),
+			'make set anaconda_location=~/libs/Miniconda3-latest-Linux-x86_64.sh '+
+				'automacs="http://github.com/biophyscode/automacs" '+
+				'omnicalc="http://github.com/biophyscode/omnicalc" setup_stamp=$(date +%s)',
+			#---the stamp skips the anaconda install so we must force the package refresh
+			'make setup refresh',]),
 		('use a template to make a new project/connection',[
 			'make template demo project_name=demo connection_file=demo.yaml',
 			'make connect demo']),
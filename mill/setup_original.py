@@ -77,5 +77,5 @@ def setup_virtualenv(sandbox=False):
 	required_upgrades = ['Sphinx>=1.4.4','numpydoc','sphinx-better-theme','beautifulsoup4']
 	bash('pip install -U %s'%' '.join(["'%s'"%i for i in required_upgrades]),log='logs/log-virtualenv-pip')
 	#---record success
-	config['setup_stamp'] = time.strftime('%Y%m%d%H%M%s')
+	config['setup_stamp'] = int(time.time())
 	write_config(config)
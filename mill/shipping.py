@@ -18,8 +18,10 @@ def test():
 	Source and test the environment.
 	"""
 	from makeface import fab
-	from distutils.spawn import find_executable
-	print(fab('ENVIRONMENT:','cyan_black')+' %s'%find_executable('python'))
+	#---distutils is gone in python 3.12 so we only fall back to it on python 2
+	try: from shutil import which
+	except ImportError: from distutils.spawn import find_executable as which
+	print(fab('ENVIRONMENT:','cyan_black')+' %s'%which('python'))
 
 def testdocker():
 	"""